@@ -1,7 +1,10 @@
+import contextlib
 import logging
-from typing import Any, Dict, Optional
+from typing import Dict, Optional, Tuple
 
+import numpy
 import torch
+from allennlp.common.checks import ConfigurationError
 from allennlp.data.fields.text_field import TextFieldTensors
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.modules import Seq2SeqEncoder, TextFieldEmbedder
@@ -28,6 +31,7 @@ class BertBackbone(Backbone):
         position_embedding_type: str = "absolute",
         activation: str = "gelu",
         hidden_dropout: float = 0.1,
+        use_bf16: bool = False,
     ) -> None:
         super().__init__()
         # TODO:
@@ -54,41 +58,113 @@ class BertBackbone(Backbone):
             use_cache=True,
         )
         self.cfg = cfg
+        # Run the BERT encoder under bfloat16 autocast when on CUDA. Needs torch>=1.10 and a GPU with bfloat16
+        # support, which is checked on the first CUDA forward pass.
+        self._use_bf16 = use_bf16
+        self._bf16_autocast = None
         self._vocab = vocab
         self._namespace = "tokens"
+        # Plain index -> token list so the per-step whole word masking doesn't go through the vocab
+        self._idx_to_token = [vocab._index_to_token["tokens"][i] for i in range(vocab.get_vocab_size("tokens"))]
         self.bert = BertModel(cfg)
         self.masking_collator = DataCollatorForWholeWordMask(tokenizer=tokenizer, mlm=True, mlm_probability=0.15)
+        # needed by _torch_mask_tokens, which replaces the collator's CPU-only torch_mask_tokens
+        self.register_buffer(
+            "_special_token_ids", torch.tensor(tokenizer.all_special_ids, dtype=torch.long), persistent=False
+        )
+        self._mask_token_id = tokenizer.mask_token_id
+        self._tokenizer_size = len(tokenizer)
 
     def _pool_token_embeddings(self, wordpiece_embeddings, offsets):
-        # Assemble wordpiece embeddings into embeddings for each word using average pooling
-        span_embeddings, span_mask = util.batched_span_select(wordpiece_embeddings.contiguous(), offsets)
-        span_mask = span_mask.unsqueeze(-1)
-        # Shape: (batch_size, num_orig_tokens, max_span_length, embedding_size)
-        span_embeddings *= span_mask  # zero out paddings
-        # return the average of embeddings of all sub-tokens of a word
-        # Sum over embeddings of all sub-tokens of a word
-        # Shape: (batch_size, num_orig_tokens, embedding_size)
-        span_embeddings_sum = span_embeddings.sum(2)
-        # Shape (batch_size, num_orig_tokens)
-        span_embeddings_len = span_mask.sum(2)
-        # Find the average of sub-tokens embeddings by dividing `span_embedding_sum` by `span_embedding_len`
+        # Assemble wordpiece embeddings into embeddings for each word using average pooling.
+        # Rather than gathering a padded (batch_size, num_orig_tokens, max_span_length, embedding_size)
+        # tensor of spans, build a span membership matrix and average with a single batched matmul.
+        # Offsets are inclusive; words without wordpieces have offsets (-1, -1) and match no position.
+        span_starts = offsets[..., 0].unsqueeze(-1)
+        span_ends = offsets[..., 1].unsqueeze(-1)
+        # Shape: (1, 1, num_wordpieces)
+        positions = torch.arange(wordpiece_embeddings.shape[1], device=offsets.device).view(1, 1, -1)
+        # Shape: (batch_size, num_orig_tokens, num_wordpieces)
+        span_mask = (positions >= span_starts) & (positions <= span_ends)
+        # Shape: (batch_size, num_orig_tokens, 1)
+        span_embeddings_len = span_mask.sum(-1, keepdim=True)
+        # All the places where the span length is zero get an all-zero row, hence a zero embedding.
+        span_weights = span_mask.to(wordpiece_embeddings.dtype) / torch.clamp_min(span_embeddings_len, 1)
         # Shape: (batch_size, num_orig_tokens, embedding_size)
-        orig_embeddings = span_embeddings_sum / torch.clamp_min(span_embeddings_len, 1)
-        # All the places where the span length is zero, write in zeros.
-        orig_embeddings[(span_embeddings_len == 0).expand(orig_embeddings.shape)] = 0
-        return orig_embeddings
+        return torch.bmm(span_weights, wordpiece_embeddings)
+
+    def _mask_text(self, input_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # get the binary mask that'll tell us which parts to mask--this is random and dynamically done.
+        # The ids are pulled to the host once, and the masks go into a single int8 buffer, which is
+        # 8x smaller than int64 to send to the device.
+        wwms = numpy.zeros(input_ids.shape, dtype=numpy.int8)
+        for i, row in enumerate(input_ids.tolist()):
+            wwm = self.masking_collator._whole_word_mask([self._idx_to_token[j] for j in row])
+            wwms[i, : len(wwm)] = wwm
+        wwms = torch.from_numpy(wwms).to(input_ids.device)
+        return self._torch_mask_tokens(input_ids, wwms)
+
+    def _torch_mask_tokens(self, input_ids: torch.Tensor, wwms: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Same as `DataCollatorForWholeWordMask.torch_mask_tokens`, but runs on `input_ids.device` so that we
+        don't have to copy the batch to the CPU and back every step. Of the positions selected by the whole
+        word mask `wwms`, 80% are replaced with [MASK], 10% with a random token and 10% are left unchanged.
+        """
+        device = input_ids.device
+        labels = input_ids.clone()
+        masked_ids = input_ids.clone()
+
+        special_tokens_mask = (input_ids.unsqueeze(-1) == self._special_token_ids).any(-1)
+        masked_indices = wwms.bool() & ~special_tokens_mask
+        labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
-    def _embed(self, text: TextFieldTensors) -> Dict[str, torch.Tensor]:
+        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=device)).bool() & masked_indices
+        masked_ids[indices_replaced] = self._mask_token_id
+
+        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5, device=device)).bool()
+        indices_random &= masked_indices & ~indices_replaced
+        random_words = torch.randint(self._tokenizer_size, labels.shape, dtype=torch.long, device=device)
+        masked_ids[indices_random] = random_words[indices_random]
+
+        return masked_ids, labels
+
+    def _get_bf16_autocast(self) -> torch.cuda.amp.autocast:
+        """
+        Builds the bfloat16 autocast context the first time it's needed and reuses it afterwards.
+        """
+        if self._bf16_autocast is None:
+            # is_bf16_supported() and autocast(dtype=...) are only there from torch 1.10 on
+            if not hasattr(torch.cuda, "is_bf16_supported") or not torch.cuda.is_bf16_supported():
+                raise ConfigurationError(
+                    "use_bf16 requires torch>=1.10 and a CUDA device with bfloat16 support (Ampere or newer), "
+                    f"but found torch {torch.__version__} on {torch.cuda.get_device_name()}."
+                )
+            self._bf16_autocast = torch.cuda.amp.autocast(dtype=torch.bfloat16)
+        return self._bf16_autocast
+
+    def _embed(self, text: TextFieldTensors, masked_ids: torch.Tensor) -> Dict[str, torch.Tensor]:
         """
         This implementation is borrowed from `PretrainedTransformerMismatchedEmbedder` and uses
         average pooling to yield a de-wordpieced embedding for each original token.
-        Returns both wordpiece embeddings+mask as well as original token embeddings+mask
+        Returns both wordpiece embeddings+mask as well as original token embeddings+mask, plus the
+        wordpiece embeddings of `masked_ids`, which are run through BERT in the same batch.
         """
         input_ids = text["tokens"]["token_ids"]
         attention_mask = text["tokens"]["wordpiece_mask"]
         token_type_ids = text["tokens"]["type_ids"]
-        output = self.bert(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        wordpiece_embeddings = output.last_hidden_state
+        use_bf16 = self._use_bf16 and input_ids.is_cuda
+        with self._get_bf16_autocast() if use_bf16 else contextlib.nullcontext():
+            # One forward pass over [unmasked; masked] instead of two: same FLOPs, half the kernel launches
+            output = self.bert(
+                input_ids=torch.cat([input_ids, masked_ids], dim=0),
+                attention_mask=attention_mask.repeat(2, 1),
+                token_type_ids=token_type_ids.repeat(2, 1),
+            )
+        last_hidden_state = output.last_hidden_state
+        if use_bf16:
+            # hand the heads float32 embeddings, as they'd get without autocast
+            last_hidden_state = last_hidden_state.float()
+        wordpiece_embeddings, masked_wordpiece_embeddings = torch.chunk(last_hidden_state, 2, dim=0)
         offsets = text["tokens"]["offsets"]
 
         if wordpiece_embeddings.shape[1] > 512:
@@ -101,10 +177,12 @@ class BertBackbone(Backbone):
             "wordpiece_embeddings": wordpiece_embeddings,
             "orig_mask": text["tokens"]["mask"],
             "orig_embeddings": orig_embeddings,
+            "masked_wordpiece_embeddings": masked_wordpiece_embeddings,
         }
 
     def forward(self, text: TextFieldTensors) -> Dict[str, torch.Tensor]:  # type: ignore
-        bert_output = self._embed(text)
+        masked_ids, masked_labels = self._mask_text(text["tokens"]["token_ids"])
+        bert_output = self._embed(text, masked_ids)
 
         outputs = {
             "encoded_text": bert_output["orig_embeddings"],
@@ -112,43 +190,14 @@ class BertBackbone(Backbone):
             "wordpiece_encoded_text": bert_output["wordpiece_embeddings"],
             "wordpiece_encoded_text_mask": bert_output["wordpiece_mask"],
             "token_ids": util.get_token_ids_from_text_field_tensors(text),
+            "encoded_masked_text": bert_output["masked_wordpiece_embeddings"],
+            "masked_text_labels": masked_labels,
         }
-
-        self._extend_with_masked_text(outputs, text)
         return outputs
 
-    def _extend_with_masked_text(self, outputs: Dict[str, Any], text: TextFieldTensors) -> None:
-        input_ids = text["tokens"]["token_ids"]
-
-        # get the binary mask that'll tell us which parts to mask--this is random and dynamically done
-        wwms = []
-        for i in range(input_ids.shape[0]):
-            tokens = [self._vocab.get_token_from_index(i.item()) for i in input_ids[i]]
-            wwm = torch.tensor(self.masking_collator._whole_word_mask(tokens)).unsqueeze(0)
-            wwms.append(wwm)
-        wwms = torch.cat(wwms, dim=0)
-
-        masked_ids, labels = self.masking_collator.torch_mask_tokens(input_ids.clone().to("cpu"), wwms.to("cpu"))
-        masked_ids = masked_ids.to(input_ids.device)
-        labels = labels.to(input_ids.device)
-        bert_output = self.bert(
-            input_ids=masked_ids,
-            attention_mask=text["tokens"]["wordpiece_mask"],
-            token_type_ids=text["tokens"]["type_ids"],
-        )
-        outputs["encoded_masked_text"] = bert_output.last_hidden_state
-        outputs["masked_text_labels"] = labels
-
     def make_output_human_readable(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
-        tokens = []
-        for instance_tokens in output_dict["token_ids"]:
-            tokens.append(
-                [
-                    self._vocab.get_token_from_index(token_id.item(), namespace=self._namespace)
-                    for token_id in instance_tokens
-                ]
-            )
-        output_dict["tokens"] = tokens
+        token_ids = output_dict["token_ids"].cpu().tolist()
+        output_dict["tokens"] = [[self._idx_to_token[token_id] for token_id in row] for row in token_ids]
         del output_dict["token_ids"]
         del output_dict["encoded_text"]
         del output_dict["encoded_text_mask"]
@@ -3,10 +3,12 @@ import glob
 import logging
 import math
 import os
+import queue
 import re
+import threading
 import time
 import warnings
-from typing import Optional, Union, List, Dict, Tuple, Any, Type
+from typing import Optional, Union, List, Dict, Tuple, Any, Type, Iterator
 
 import torch
 from torch.cuda import amp
@@ -37,6 +39,209 @@ from allennlp.training import util as training_util
 logger = logging.getLogger(__name__)
 
 
+def _move_to_device_non_blocking(obj: Any, device: torch.device) -> Any:
+    """
+    Like `allennlp.nn.util.move_to_device`, but issues the copies with `non_blocking=True` so that
+    they are asynchronous with respect to the host when the source tensors are in pinned memory.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device, non_blocking=True)
+    elif isinstance(obj, dict):
+        return {key: _move_to_device_non_blocking(value, device) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_move_to_device_non_blocking(item, device) for item in obj]
+    elif isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        return obj.__class__(*(_move_to_device_non_blocking(item, device) for item in obj))
+    elif isinstance(obj, tuple):
+        return tuple(_move_to_device_non_blocking(item, device) for item in obj)
+    else:
+        return obj
+
+
+def _pin_tensor_dict(obj: Any) -> Any:
+    """
+    Copies every CPU tensor in a (nested) `TensorDict` into page-locked memory. Without this, a
+    `non_blocking=True` copy to the GPU silently degrades into a synchronous one. Tensors that are
+    already pinned are left alone.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.pin_memory() if obj.device.type == "cpu" and not obj.is_pinned() else obj
+    elif isinstance(obj, dict):
+        return {key: _pin_tensor_dict(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_pin_tensor_dict(item) for item in obj]
+    elif isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        return obj.__class__(*(_pin_tensor_dict(item) for item in obj))
+    elif isinstance(obj, tuple):
+        return tuple(_pin_tensor_dict(item) for item in obj)
+    else:
+        return obj
+
+
+def _iter_tensors(obj: Any) -> Iterator[torch.Tensor]:
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _iter_tensors(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _iter_tensors(item)
+
+
+class _PrefetchGenerator(threading.Thread):
+    """
+    Drains an iterator over batches on a daemon thread into a bounded queue, so that building the
+    next batches overlaps with the training step on the main thread. Exceptions raised by the
+    wrapped iterator are re-raised in the consumer. With `pin_memory=True`, batches are also copied
+    into page-locked memory on this thread, off the critical path of the training step.
+    """
+
+    _SENTINEL = object()
+
+    def __init__(self, batches: Iterator[TensorDict], queue_size: int, pin_memory: bool = False) -> None:
+        super().__init__(daemon=True)
+        self.batches = batches
+        self.pin_memory = pin_memory
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.closed = threading.Event()
+        self.start()
+
+    def run(self) -> None:
+        try:
+            for batch in self.batches:
+                if self.pin_memory:
+                    batch = _pin_tensor_dict(batch)
+                if not self._put(batch):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._SENTINEL)
+
+    def _put(self, item: Any) -> bool:
+        # Time out periodically so that the thread can exit once the consumer has gone away.
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self) -> Iterator[TensorDict]:
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._SENTINEL:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.closed.set()
+
+
+def _dict_tensor_keypaths(obj: Any, prefix: Tuple[str, ...] = ()) -> List[Tuple[str, ...]]:
+    """
+    Returns the key paths of all tensors in `obj` that are reachable through nested dicts only.
+    """
+    if isinstance(obj, torch.Tensor):
+        return [prefix]
+    elif isinstance(obj, dict):
+        return [path for key, value in obj.items() for path in _dict_tensor_keypaths(value, prefix + (key,))]
+    else:
+        return []
+
+
+def _tensor_layout(obj: Any) -> Any:
+    """
+    Returns a hashable description of where the tensors in a (nested) `TensorDict` are: dicts are
+    described by their keys and values, tensors by `torch.Tensor`, lists and tuples by whether they
+    contain any tensors, and all other leaves by `None`. Two batches with equal layouts have their
+    tensors at exactly the same key paths.
+    """
+    if isinstance(obj, torch.Tensor):
+        return torch.Tensor
+    elif isinstance(obj, dict):
+        return tuple((key, _tensor_layout(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return (list, any(True for _ in _iter_tensors(obj)))
+    else:
+        return None
+
+
+class _CudaPrefetcher:
+    """
+    Wraps an iterator over CPU batches and copies each batch to `device` on a dedicated CUDA stream,
+    one batch ahead of the consumer. This overlaps the host-to-device transfer of the next batch with
+    the forward/backward pass on the current one instead of serializing the two. CPU tensors that
+    are not pinned yet (e.g. when there is no `_PrefetchGenerator` upstream) are pinned here.
+    """
+
+    def __init__(self, batches: Iterator[TensorDict], device: torch.device) -> None:
+        self.batches = batches
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.next_batch: Optional[TensorDict] = None
+        self.next_tensors: List[torch.Tensor] = []
+        # Key paths to the tensors of a batch, keyed by the batch's `_tensor_layout`. Batches from the
+        # same task share a layout, so after the first one we can pin and copy in a flat loop instead of
+        # rebuilding the `TensorDict`. `None` marks layouts with tensors nested in lists, which take the
+        # recursive path instead.
+        self._tensor_keypaths: Dict[Any, Optional[List[Tuple[str, ...]]]] = {}
+        self.prefetch()
+
+    def prefetch(self) -> None:
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            self.next_batch = None
+            self.next_tensors = []
+            return
+
+        layout = _tensor_layout(batch)
+        if layout not in self._tensor_keypaths:
+            keypaths = _dict_tensor_keypaths(batch)
+            num_tensors = sum(1 for _ in _iter_tensors(batch))
+            self._tensor_keypaths[layout] = keypaths if len(keypaths) == num_tensors else None
+        keypaths = self._tensor_keypaths[layout]
+
+        with torch.cuda.stream(self.stream):
+            if keypaths is None:
+                batch = _move_to_device_non_blocking(_pin_tensor_dict(batch), self.device)
+                self.next_tensors = list(_iter_tensors(batch))
+            else:
+                self.next_tensors = []
+                for path in keypaths:
+                    parent = batch
+                    for key in path[:-1]:
+                        parent = parent[key]
+                    tensor = parent[path[-1]]
+                    if tensor.device.type == "cpu" and not tensor.is_pinned():
+                        tensor = tensor.pin_memory()
+                    tensor = tensor.to(self.device, non_blocking=True)
+                    parent[path[-1]] = tensor
+                    self.next_tensors.append(tensor)
+        self.next_batch = batch
+
+    def __iter__(self) -> "_CudaPrefetcher":
+        return self
+
+    def __next__(self) -> TensorDict:
+        if self.next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        # The tensors were allocated on the side stream; tell the caching allocator that they are
+        # now used on the compute stream so their memory isn't reused before the step is done.
+        for tensor in self.next_tensors:
+            tensor.record_stream(current_stream)
+        self.prefetch()
+        return batch
+
+
 @Trainer.register("mtl", constructor="from_partial_objects")
 class MtlTrainer(Trainer):
     """
@@ -215,6 +420,17 @@ class MtlTrainer(Trainer):
         !!! Note
             This is required for distributed training.
 
+    prefetch_queue_size : `int`, optional (default = `0`)
+        If positive, training batches are produced by a background thread that stays up to this many
+        batches ahead of the training loop, so that batch construction overlaps with the
+        forward/backward pass. With `0`, the data loader is iterated on the main thread.
+
+        !!! Note
+            AllenNLP's data loaders shuffle with the global `random` module, which the model may also
+            draw from during the forward pass (e.g. whole word masking in `BertBackbone`). With a
+            prefetch thread, the order of those draws depends on thread scheduling, so runs are no
+            longer reproducible from `random_seed`.
+
     """
 
     def __init__(
@@ -244,6 +460,7 @@ class MtlTrainer(Trainer):
         run_confidence_checks: bool = True,
         grad_scaling: bool = True,
         ddp_wrapped_model: Optional[DdpWrappedModel] = None,
+        prefetch_queue_size: int = 0,
         **kwargs,
     ) -> None:
         super().__init__(
@@ -266,10 +483,16 @@ class MtlTrainer(Trainer):
         self.model = model
 
         self.data_loader = data_loader
-        self.data_loader.set_target_device(self.cuda_device)
+        # On GPU, batches are moved to the device by `_CudaPrefetcher` rather than by the data
+        # loaders, so that the copy of the next batch overlaps with the current step.
+        self._prefetch_to_device = self.cuda_device.type == "cuda"
+        self.data_loader.set_target_device(None if self._prefetch_to_device else self.cuda_device)
+        if prefetch_queue_size < 0:
+            raise ConfigurationError(f"prefetch_queue_size must be non-negative, got {prefetch_queue_size}")
+        self._prefetch_queue_size = prefetch_queue_size
         self._validation_data_loader = validation_data_loader
         if self._validation_data_loader is not None:
-            self._validation_data_loader.set_target_device(self.cuda_device)
+            self._validation_data_loader.set_target_device(None if self._prefetch_to_device else self.cuda_device)
         self.optimizer = optimizer
 
         if patience is None:  # no early stopping
@@ -441,12 +664,10 @@ class MtlTrainer(Trainer):
         # Set the model to "train" mode.
         self._pytorch_model.train()
 
-        # Get tqdm for the training batches
-        batch_generator = iter(self.data_loader)
-        batch_group_generator = common_util.lazy_groups_of(batch_generator, self._num_gradient_accumulation_steps)
-
         logger.info("Training")
 
+        # Take the length before anything starts iterating the data loader: the prefetchers below pull
+        # batches eagerly, and AllenNLP's loaders fill the instance cache that `len()` relies on as they go.
         num_training_batches: Union[int, float]
         try:
             len_data_loader = len(self.data_loader)
@@ -454,6 +675,16 @@ class MtlTrainer(Trainer):
         except TypeError:
             num_training_batches = float("inf")
 
+        # Get tqdm for the training batches
+        batch_generator = iter(self.data_loader)
+        if self._prefetch_queue_size > 0:
+            batch_generator = iter(
+                _PrefetchGenerator(batch_generator, self._prefetch_queue_size, pin_memory=self._prefetch_to_device)
+            )
+        if self._prefetch_to_device:
+            batch_generator = _CudaPrefetcher(batch_generator, self.cuda_device)
+        batch_group_generator = common_util.lazy_groups_of(batch_generator, self._num_gradient_accumulation_steps)
+
         # Having multiple tqdm bars in case of distributed training will be a mess. Hence only the primary's
         # progress is shown
         if self._primary:
@@ -639,12 +870,24 @@ class MtlTrainer(Trainer):
 
             regularization_penalty = self.model.get_regularization_penalty()
 
+            # Take the length first: `_CudaPrefetcher` fetches a batch as soon as it's built, which would
+            # partly fill the loader's instance cache and make `len()` skip the full read.
+            num_validation_batches: Optional[int]
+            try:
+                num_validation_batches = len(validation_data_loader)
+            except TypeError:
+                num_validation_batches = None
+
+            val_batch_generator = iter(validation_data_loader)
+            if self._prefetch_to_device:
+                val_batch_generator = _CudaPrefetcher(val_batch_generator, self.cuda_device)
+
             # Having multiple tqdm bars in case of distributed training will be a mess. Hence only the primary's
             # progress is shown
             if self._primary:
-                val_generator_tqdm = Tqdm.tqdm(validation_data_loader)
+                val_generator_tqdm = Tqdm.tqdm(val_batch_generator, total=num_validation_batches)
             else:
-                val_generator_tqdm = validation_data_loader
+                val_generator_tqdm = val_batch_generator
 
             batches_this_epoch = 0
             val_loss = 0.0
@@ -1082,6 +1325,7 @@ class MtlTrainer(Trainer):
         run_confidence_checks: bool = True,
         grad_scaling: bool = True,
         ddp_accelerator: Optional[DdpAccelerator] = None,
+        prefetch_queue_size: int = 0,
         **kwargs,
     ) -> Trainer:
         """
@@ -1186,6 +1430,7 @@ class MtlTrainer(Trainer):
             run_confidence_checks=run_confidence_checks,
             grad_scaling=grad_scaling,
             ddp_wrapped_model=ddp_wrapped_model,
+            prefetch_queue_size=prefetch_queue_size,
             **kwargs,
         )
 
@@ -0,0 +1,112 @@
+import torch
+from allennlp.nn import util
+
+from embur.models.backbones.bert_backbone import BertBackbone
+
+
+def batched_span_select_pool(wordpiece_embeddings, offsets):
+    # The pooling BertBackbone used before it switched to a span membership matmul
+    span_embeddings, span_mask = util.batched_span_select(wordpiece_embeddings.contiguous(), offsets)
+    span_mask = span_mask.unsqueeze(-1)
+    span_embeddings *= span_mask
+    span_embeddings_sum = span_embeddings.sum(2)
+    span_embeddings_len = span_mask.sum(2)
+    orig_embeddings = span_embeddings_sum / torch.clamp_min(span_embeddings_len, 1)
+    orig_embeddings[(span_embeddings_len == 0).expand(orig_embeddings.shape)] = 0
+    return orig_embeddings
+
+
+class TestBertBackbonePooling:
+    def setup_method(self):
+        torch.manual_seed(0)
+        # _pool_token_embeddings doesn't depend on any state, so skip building a tokenizer and a BERT
+        self.backbone = BertBackbone.__new__(BertBackbone)
+        # Inclusive wordpiece spans: single and multi-wordpiece words, a word without wordpieces (-1, -1),
+        # and padded words (0, 0), which overlap [CLS]
+        self.offsets = torch.tensor(
+            [
+                [[1, 1], [2, 4], [5, 5], [0, 0]],
+                [[1, 2], [-1, -1], [3, 3], [0, 0]],
+            ]
+        )
+        self.wordpiece_embeddings = torch.randn(2, 7, 5, dtype=torch.float64)
+
+    def test_matches_batched_span_select(self):
+        expected = batched_span_select_pool(self.wordpiece_embeddings, self.offsets)
+        actual = self.backbone._pool_token_embeddings(self.wordpiece_embeddings, self.offsets)
+
+        assert actual.shape == (2, 4, 5)
+        assert torch.allclose(actual, expected)
+        # multi-wordpiece spans are averaged
+        assert torch.allclose(actual[0, 1], self.wordpiece_embeddings[0, 2:5].mean(0))
+        # padded spans pick up [CLS], like before
+        assert torch.allclose(actual[:, 3], self.wordpiece_embeddings[:, 0])
+        # words without wordpieces are zero
+        assert torch.all(actual[1, 1] == 0)
+
+    def test_gradients_match_batched_span_select(self):
+        upstream = torch.randn(2, 4, 5, dtype=torch.float64)
+
+        expected_input = self.wordpiece_embeddings.clone().requires_grad_()
+        (batched_span_select_pool(expected_input, self.offsets) * upstream).sum().backward()
+        actual_input = self.wordpiece_embeddings.clone().requires_grad_()
+        (self.backbone._pool_token_embeddings(actual_input, self.offsets) * upstream).sum().backward()
+
+        assert torch.allclose(actual_input.grad, expected_input.grad)
+        assert torch.autograd.gradcheck(
+            lambda embeddings: self.backbone._pool_token_embeddings(embeddings, self.offsets),
+            (self.wordpiece_embeddings.clone().requires_grad_(),),
+        )
+
+
+class TestBertBackboneMasking:
+    PAD, UNK, CLS, SEP, MASK = 0, 1, 2, 3, 4
+
+    def setup_method(self):
+        torch.manual_seed(0)
+        # Only the attributes _torch_mask_tokens reads, instead of a tokenizer and a BERT
+        self.backbone = BertBackbone.__new__(BertBackbone)
+        torch.nn.Module.__init__(self.backbone)
+        self.backbone._special_token_ids = torch.tensor([self.PAD, self.UNK, self.CLS, self.SEP, self.MASK])
+        self.backbone._mask_token_id = self.MASK
+        self.backbone._tokenizer_size = 1000
+
+        # [CLS] w_1 ... w_n [SEP] [PAD] ..., with a few [UNK]s in between
+        batch_size, seq_len = 1024, 32
+        self.input_ids = torch.randint(5, 1000, (batch_size, seq_len))
+        lengths = torch.randint(4, seq_len, (batch_size,))
+        positions = torch.arange(seq_len).unsqueeze(0)
+        self.input_ids[positions >= lengths.unsqueeze(1)] = self.PAD
+        self.input_ids[positions == (lengths - 1).unsqueeze(1)] = self.SEP
+        self.input_ids[:, 0] = self.CLS
+        self.input_ids[(torch.rand(batch_size, seq_len) < 0.02) & (self.input_ids >= 5)] = self.UNK
+        self.special = (self.input_ids.unsqueeze(-1) == self.backbone._special_token_ids).any(-1)
+        # Whole word masks that also (wrongly) select special and padding positions, which must be ignored
+        self.wwms = (torch.rand(batch_size, seq_len) < 0.5).to(torch.int8)
+
+    def test_only_selected_non_special_positions_are_masked(self):
+        masked_ids, labels = self.backbone._torch_mask_tokens(self.input_ids, self.wwms)
+        masked = self.wwms.bool() & ~self.special
+
+        assert torch.equal(labels == -100, ~masked)
+        assert torch.equal(labels[masked], self.input_ids[masked])
+        assert torch.equal(masked_ids[~masked], self.input_ids[~masked])
+        # in particular, special tokens and [PAD] are never touched
+        assert torch.equal(masked_ids[self.special], self.input_ids[self.special])
+        assert torch.all(labels[self.input_ids == self.PAD] == -100)
+        # and the input itself isn't modified in place
+        assert masked_ids.data_ptr() != self.input_ids.data_ptr()
+
+    def test_masked_positions_split_80_10_10(self):
+        masked_ids, labels = self.backbone._torch_mask_tokens(self.input_ids, self.wwms)
+        masked = labels != -100
+        num_masked = masked.sum().item()
+        assert num_masked > 5000
+
+        replaced = (masked_ids[masked] == self.MASK).float().mean().item()
+        unchanged = (masked_ids[masked] == self.input_ids[masked]).float().mean().item()
+        randomized = 1 - replaced - unchanged
+
+        assert abs(replaced - 0.8) < 0.02
+        assert abs(unchanged - 0.1) < 0.02
+        assert abs(randomized - 0.1) < 0.02
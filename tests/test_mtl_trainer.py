@@ -0,0 +1,36 @@
+import itertools
+
+import pytest
+
+from embur.mtl_trainer import _PrefetchGenerator
+
+
+class TestPrefetchGenerator:
+    def test_preserves_order_and_stops_at_end(self):
+        producer = _PrefetchGenerator(iter(range(10)), queue_size=2)
+
+        assert list(producer) == list(range(10))
+        producer.join(timeout=5)
+        assert not producer.is_alive()
+
+    def test_reraises_exceptions_from_wrapped_iterator(self):
+        def batches():
+            yield 0
+            yield 1
+            raise ValueError("broken batch")
+
+        consumed = []
+        with pytest.raises(ValueError, match="broken batch"):
+            for batch in _PrefetchGenerator(batches(), queue_size=2):
+                consumed.append(batch)
+        assert consumed == [0, 1]
+
+    def test_producer_exits_when_consumer_stops_early(self):
+        # The wrapped iterator never ends, so the producer is blocked on a full queue when we stop
+        producer = _PrefetchGenerator(itertools.count(), queue_size=2)
+        for batch in producer:
+            if batch == 3:
+                break
+
+        producer.join(timeout=5)
+        assert not producer.is_alive()